@@ -8,223 +8,306 @@ ToHeart LZSS圧縮アルゴリズムの機械学習による解析
 """
 
 import os
+import importlib.util
+import multiprocessing
 import sys
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data import Dataset, DataLoader
-from typing import List, Tuple, Dict, Optional
+from typing import List, Tuple, Optional
 import struct
 import json
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        """numba未導入時は素のPython関数として実行"""
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
+
+# LF2ヘッダーの幅・高さ (offset 12, little-endian u16 x2)
+_HDR = struct.Struct('<HH')
+
+# 正規化係数（float32のまま乗算し、float64除算を経由しない）
+_INV_255 = np.float32(1.0 / 255.0)
+_INV_4096 = np.float32(1.0 / 4096.0)
+
+# 文脈特徴の次元数（リングバッファ32 + 位置・進行度4 + マッチ特徴3）
+_FEATURE_DIM = 39
+
+# リングバッファ直近32バイトのオフセット（古い順）
+_RING_OFFS = np.arange(-32, 0, dtype=np.int32)
+
+# 利用可能マッチの特徴量（簡易版）
+# オフセット1-1023を8バイトおきにサンプリングした件数を距離帯別に正規化したもの:
+# 近距離(0-255) 32件/32, 中距離(256-511) 32件/32, 遠距離(512+) 64件/64
+_MATCH_FEATS = np.array([32 / 32.0, 32 / 32.0, 64 / 64.0], dtype=np.float32)
+_MATCH_FEATS.setflags(write=False)
+
+# テンソルキャッシュの形式バージョン（特徴量・解析処理を変更したら更新する）
+_CACHE_VERSION = 1
+
+# 決定レコード: type 0=直接ピクセル / 1=マッチ, v1=ピクセル値 または マッチ位置, v2=マッチ長-3
+_DECISION_DTYPE = np.dtype([('type', 'u1'), ('v1', 'u2'), ('v2', 'u1')])
+
+@njit(cache=True, boundscheck=False)
+def _parse_lf2(comp: np.ndarray, max_decisions: int):
+    """LZSS決定シーケンス抽出のホットループ（XOR復号済みの圧縮データを入力）
+    
+    戻り値: (ring_out, types, v1, v2, ring_positions, data_positions, n)
+      ring_out[i]: 決定直前のリングバッファ直近32バイト
+      types[i]: 0=直接ピクセル, 1=マッチ参照
+      v1[i]: ピクセル値 または マッチ位置
+      v2[i]: マッチ長-3 (0-15)
+    """
+    comp_len = comp.shape[0]
+    capacity = min(max_decisions, comp_len)
+    
+    ring_out = np.empty((capacity, 32), dtype=np.uint8)
+    types = np.empty(capacity, dtype=np.uint8)
+    v1 = np.empty(capacity, dtype=np.uint16)
+    v2 = np.empty(capacity, dtype=np.uint8)
+    ring_positions = np.empty(capacity, dtype=np.int32)
+    data_positions = np.empty(capacity, dtype=np.int32)
+    
+    ring = np.full(0x1000, 0x20, dtype=np.uint8)
+    ring_pos = 0x0fee
+    pos = 0
+    flag_count = 0
+    flag = 0
+    n = 0
+    
+    while pos < comp_len and n < capacity:
+        if flag_count == 0:
+            flag = int(comp[pos])
+            pos += 1
+            flag_count = 8
+        
+        if pos >= comp_len:
+            break
+        
+        # 文脈（決定直前の状態）を記録
+        ring_out[n] = ring[(ring_pos + _RING_OFFS) & 0x0fff]
+        ring_positions[n] = ring_pos
+        data_positions[n] = pos
+        
+        # フラグビットはMSBから順に判定
+        if (flag >> (flag_count - 1)) & 1:
+            # 直接ピクセル
+            pixel = comp[pos]
+            pos += 1
+            
+            ring[ring_pos] = pixel
+            ring_pos = (ring_pos + 1) & 0x0fff
+            
+            types[n] = 0
+            v1[n] = pixel
+            v2[n] = 0
+            n += 1
+        elif pos + 1 < comp_len:
+            # マッチ参照
+            upper = int(comp[pos])
+            lower = int(comp[pos + 1])
+            pos += 2
+            
+            length_code = upper & 0x0f
+            position = ((upper >> 4) + (lower << 4)) & 0x0fff
+            
+            # リングバッファ更新
+            length = length_code + 3
+            copy_pos = position
+            if (copy_pos + length <= 0x1000 and ring_pos + length <= 0x1000
+                    and (copy_pos + length <= ring_pos or copy_pos >= ring_pos + length)):
+                # 折り返し・自己重複なし: 一括スライスコピー
+                ring[ring_pos:ring_pos + length] = ring[copy_pos:copy_pos + length]
+                ring_pos = (ring_pos + length) & 0x0fff
+            else:
+                # 直前に書いたバイトを読む自己重複（RLE的参照）は1バイトずつ
+                for _ in range(length):
+                    ring[ring_pos] = ring[copy_pos]
+                    ring_pos = (ring_pos + 1) & 0x0fff
+                    copy_pos = (copy_pos + 1) & 0x0fff
+            
+            types[n] = 1
+            v1[n] = position
+            v2[n] = length_code
+            n += 1
+        
+        flag_count -= 1
+    
+    return ring_out, types, v1, v2, ring_positions, data_positions, n
 
 class LF2DecisionDataset(Dataset):
     """LF2圧縮決定データセット"""
     
     def __init__(self, lf2_files: List[str], max_decisions_per_file: int = 10000):
-        self.decisions = []
-        self.contexts = []
+        # 決定数の上限から一括確保し、ファイル毎の結果をカーソル位置へ書き込む
+        total_cap = len(lf2_files) * max_decisions_per_file
+        self.contexts_arr = np.empty((total_cap, _FEATURE_DIM), dtype=np.float32)
+        self.dec_arr = np.empty(total_cap, dtype=_DECISION_DTYPE)
+        cursor = 0
         
         print(f"🔬 Loading {len(lf2_files)} LF2 files for analysis...")
         
-        for i, file_path in enumerate(lf2_files):
+        results = _iter_parsed(lf2_files, max_decisions_per_file)
+        for i, (file_path, (decisions, contexts, error)) in enumerate(zip(lf2_files, results)):
             if i % 50 == 0:
                 print(f"   Processing file {i+1}/{len(lf2_files)}: {os.path.basename(file_path)}")
             
-            try:
-                decisions, contexts = self.extract_decisions_from_lf2(file_path, max_decisions_per_file)
-                self.decisions.extend(decisions)
-                self.contexts.extend(contexts)
-            except Exception as e:
-                print(f"   ⚠️  Error processing {file_path}: {e}")
+            if error is not None:
+                print(f"   ⚠️  Error processing {file_path}: {error}")
                 continue
+            
+            n = len(decisions)
+            self.dec_arr[cursor:cursor + n] = decisions
+            self.contexts_arr[cursor:cursor + n] = contexts
+            cursor += n
+        
+        self.dec_arr = self.dec_arr[:cursor]
+        self.contexts_arr = self.contexts_arr[:cursor]
         
-        print(f"✅ Loaded {len(self.decisions)} decision points from {len(lf2_files)} files")
+        print(f"✅ Loaded {cursor} decision points from {len(lf2_files)} files")
         
-    def extract_decisions_from_lf2(self, file_path: str, max_decisions: int) -> Tuple[List[Dict], List[np.ndarray]]:
-        """LF2ファイルから決定シーケンスと文脈を抽出"""
+        self._tensorize()
+    
+    @classmethod
+    def from_tensors(cls, contexts_t: torch.Tensor, labels_t: torch.Tensor,
+                     values_t: torch.Tensor) -> 'LF2DecisionDataset':
+        """キャッシュ済みテンソルからデータセットを構築（LF2解析を省略）"""
+        dataset = cls.__new__(cls)
+        dataset.contexts_t = contexts_t
+        dataset.labels_t = labels_t
+        dataset.values_t = values_t
+        return dataset
+    
+    def _tensorize(self):
+        """文脈とターゲットを一括でテンソル化（__getitem__はスライスのみ）"""
+        self.contexts_t = torch.from_numpy(self.contexts_arr)
+        
+        labels, value_mat = self.build_targets(self.dec_arr)
+        self.labels_t = torch.from_numpy(labels)
+        self.values_t = torch.from_numpy(value_mat)
+    
+    @staticmethod
+    def build_targets(dec_arr: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """構造化決定配列から決定ラベルと正規化値を一括生成"""
+        
+        # 決定ラベル (0=直接ピクセル, 1=マッチ) はtypeフィールドそのもの
+        # 値: 直接ピクセル [pixel_value/255, 0, 0] / マッチ [0, position/4096, (length-3)/15]
+        labels = dec_arr['type'].astype(np.int64)
+        is_match = labels == 1
+        is_direct = ~is_match
+        
+        value_mat = np.zeros((len(dec_arr), 3), dtype=np.float32)
+        value_mat[is_direct, 0] = dec_arr['v1'][is_direct] * _INV_255
+        value_mat[is_match, 1] = dec_arr['v1'][is_match] * _INV_4096
+        value_mat[is_match, 2] = dec_arr['v2'][is_match] / 15.0  # 3-18 -> 0-15
+        
+        return labels, value_mat
+    
+    @staticmethod
+    def extract_decisions_from_lf2(file_path: str, max_decisions: int) -> Tuple[np.ndarray, np.ndarray]:
+        """LF2ファイルから決定シーケンス（構造化配列）と文脈 (N, F) を抽出"""
         
-        with open(file_path, 'rb') as f:
-            data = f.read()
+        # ファイルをメモリマップし、bytesへの読み込みコピーを省く
+        data = np.memmap(file_path, dtype=np.uint8, mode='r')
         
         # ヘッダー解析
-        if len(data) < 0x18 or data[:8] != b'LEAF256\0':
+        if len(data) < 0x18 or data[:8].tobytes() != b'LEAF256\0':
             raise ValueError("Invalid LF2 file")
         
-        width = struct.unpack('<H', data[12:14])[0]
-        height = struct.unpack('<H', data[14:16])[0]
-        color_count = data[0x16]
+        width, height = _HDR.unpack_from(data, 12)
+        color_count = int(data[0x16])
         
-        # 圧縮データ開始位置
+        # 圧縮データ開始位置（XOR 0xffを全体に一括適用して復号）
         pixel_data_start = 0x18 + color_count * 3
-        compressed_data = data[pixel_data_start:]
-        
-        # 決定シーケンスを抽出
-        decisions = []
-        contexts = []
-        
-        ring = np.full(0x1000, 0x20, dtype=np.uint8)
-        ring_pos = 0x0fee
-        pos = 0
-        flag_count = 0
-        current_flag = 0
-        decision_count = 0
-        
-        # Y-flipピクセルデータを準備（エンコード時の入力再現）
-        total_pixels = width * height
-        
-        while pos < len(compressed_data) and decision_count < max_decisions:
-            if flag_count == 0:
-                if pos >= len(compressed_data):
-                    break
-                current_flag = compressed_data[pos] ^ 0xff
-                pos += 1
-                flag_count = 8
-            
-            if pos >= len(compressed_data):
-                break
-                
-            # 文脈特徴を抽出
-            context = self.extract_context_features(
-                ring, ring_pos, pos, compressed_data, 
-                width, height, decision_count
-            )
-            
-            # フラグビットから決定を読み取り
-            bit_pos = 8 - flag_count
-            is_direct = (current_flag >> (7 - bit_pos)) & 1 != 0
-            
-            if is_direct:
-                # 直接ピクセル
-                if pos < len(compressed_data):
-                    pixel = compressed_data[pos] ^ 0xff
-                    decision = {
-                        'type': 'direct',
-                        'value': pixel
-                    }
-                    
-                    # リングバッファ更新
-                    ring[ring_pos] = pixel
-                    ring_pos = (ring_pos + 1) & 0x0fff
-                    pos += 1
-                    
-                    decisions.append(decision)
-                    contexts.append(context)
-                    decision_count += 1
-            else:
-                # マッチ参照
-                if pos + 1 < len(compressed_data):
-                    upper = compressed_data[pos] ^ 0xff
-                    lower = compressed_data[pos + 1] ^ 0xff
-                    pos += 2
-                    
-                    length = (upper & 0x0f) + 3
-                    position = ((upper >> 4) + (lower << 4)) & 0x0fff
-                    
-                    decision = {
-                        'type': 'match',
-                        'position': position,
-                        'length': length
-                    }
-                    
-                    # リングバッファ更新
-                    copy_pos = position
-                    for _ in range(length):
-                        byte_val = ring[copy_pos]
-                        ring[ring_pos] = byte_val
-                        ring_pos = (ring_pos + 1) & 0x0fff
-                        copy_pos = (copy_pos + 1) & 0x0fff
-                    
-                    decisions.append(decision)
-                    contexts.append(context)
-                    decision_count += 1
-            
-            flag_count -= 1
+        comp = data[pixel_data_start:] ^ np.uint8(0xff)
+        
+        # 決定シーケンスを抽出（ホットループはコンパイル済みカーネルで実行）
+        ring_out, types, v1, v2, ring_positions, data_positions, n = _parse_lf2(comp, max_decisions)
+        
+        decisions = np.empty(n, dtype=_DECISION_DTYPE)
+        decisions['type'] = types[:n]
+        decisions['v1'] = v1[:n]
+        decisions['v2'] = v2[:n]
+        
+        # 文脈特徴を抽出
+        contexts = LF2DecisionDataset.extract_context_features(
+            ring_out[:n], ring_positions[:n], data_positions[:n], len(comp),
+            width, height
+        )
         
         return decisions, contexts
     
-    def extract_context_features(self, ring: np.ndarray, ring_pos: int, 
-                                data_pos: int, compressed_data: bytes,
-                                width: int, height: int, decision_idx: int) -> np.ndarray:
-        """決定時の文脈特徴を抽出"""
-        
-        features = []
+    @staticmethod
+    def extract_context_features(ring_windows: np.ndarray, ring_positions: np.ndarray,
+                                data_positions: np.ndarray, compressed_len: int,
+                                width: int, height: int) -> np.ndarray:
+        """決定時の文脈特徴を1ファイル分まとめて抽出（ring_windows[i]はi番目の決定直前の直近32バイト）"""
+        n = len(ring_windows)
+        features = np.empty((n, _FEATURE_DIM), dtype=np.float32)
         
         # 1. リングバッファの現在状態 (最近の32バイト)
-        ring_context = np.zeros(32, dtype=np.float32)
-        for i in range(32):
-            pos = (ring_pos - 32 + i) & 0x0fff
-            ring_context[i] = ring[pos] / 255.0
-        features.extend(ring_context)
+        features[:, :32] = ring_windows.astype(np.float32) * _INV_255
         
         # 2. リングバッファ位置の正規化
-        features.append(ring_pos / 0x1000)
+        features[:, 32] = ring_positions.astype(np.float32) * _INV_4096
         
         # 3. 圧縮進行度
-        features.append(data_pos / len(compressed_data) if len(compressed_data) > 0 else 0.0)
+        features[:, 33] = data_positions / compressed_len if compressed_len > 0 else 0.0
         
-        # 4. 画像内位置の推定
-        estimated_pixel_pos = decision_idx
-        estimated_x = (estimated_pixel_pos % width) / width if width > 0 else 0.0
-        estimated_y = (estimated_pixel_pos // width) / height if height > 0 else 0.0
-        features.extend([estimated_x, estimated_y])
+        # 4. 画像内位置の推定（決定インデックスを画素位置とみなす）
+        estimated_pixel_pos = np.arange(n)
+        if width > 0:
+            features[:, 34] = (estimated_pixel_pos % width) / width
+            features[:, 35] = (estimated_pixel_pos // width) / height if height > 0 else 0.0
+        else:
+            features[:, 34:36] = 0.0
         
         # 5. 利用可能マッチの特徴（簡易版）
-        available_matches = self.find_available_matches_features(ring, ring_pos)
-        features.extend(available_matches)
-        
-        return np.array(features, dtype=np.float32)
-    
-    def find_available_matches_features(self, ring: np.ndarray, ring_pos: int) -> List[float]:
-        """利用可能マッチの特徴量を計算"""
-        
-        features = []
-        
-        # 近距離マッチの数（簡易計算）
-        short_matches = 0  # 0-255バイト範囲
-        medium_matches = 0  # 256-511バイト範囲
-        long_matches = 0   # 512+バイト範囲
-        
-        # サンプリングによる高速推定
-        for offset in range(1, min(1024, 0x1000), 8):  # 8バイトおきにサンプリング
-            start_pos = (ring_pos - offset) & 0x0fff
-            
-            if offset <= 255:
-                short_matches += 1
-            elif offset <= 511:
-                medium_matches += 1
-            else:
-                long_matches += 1
-        
-        features.extend([
-            short_matches / 32.0,   # 正規化
-            medium_matches / 32.0,
-            long_matches / 64.0
-        ])
+        features[:, 36:] = LF2DecisionDataset.find_available_matches_features(ring_windows, ring_positions)
         
         return features
     
+    @staticmethod
+    def find_available_matches_features(ring: np.ndarray, ring_pos: np.ndarray) -> np.ndarray:
+        """利用可能マッチの特徴量を計算（現状はリング内容に依存しない定数）"""
+        return _MATCH_FEATS
+    
     def __len__(self):
-        return len(self.decisions)
+        return len(self.contexts_t)
     
     def __getitem__(self, idx):
-        decision = self.decisions[idx]
-        context = self.contexts[idx]
-        
-        # 決定をワンホットエンコード
-        if decision['type'] == 'direct':
-            # 直接ピクセル: [1, 0, pixel_value/255, 0, 0]
-            target = torch.tensor([1.0, 0.0, decision['value']/255.0, 0.0, 0.0])
-        else:
-            # マッチ: [0, 1, 0, position/4096, length/18]
-            target = torch.tensor([
-                0.0, 1.0, 0.0, 
-                decision['position']/4096.0, 
-                (decision['length']-3)/15.0  # 3-18 -> 0-15
-            ])
-        
-        return torch.tensor(context), target
+        return self.contexts_t[idx], self.labels_t[idx], self.values_t[idx]
+
+def _parse_one(file_path: str, max_decisions_per_file: int) -> Tuple[Optional[np.ndarray], Optional[np.ndarray], Optional[str]]:
+    """単一LF2ファイルの決定・文脈を抽出（ワーカー用: 解析エラーを例外ではなく戻り値で返す）"""
+    try:
+        decisions, contexts = LF2DecisionDataset.extract_decisions_from_lf2(file_path, max_decisions_per_file)
+    except Exception as e:
+        return None, None, str(e)
+    return decisions, contexts, None
+
+def _iter_parsed(lf2_files: List[str], max_decisions_per_file: int):
+    """ファイル順に解析結果を返す（複数ファイルはプロセスプールで並列、単一ファイルはその場で解析）"""
+    if len(lf2_files) <= 1:
+        yield from map(_parse_one, lf2_files, repeat(max_decisions_per_file))
+        return
+    
+    # 呼び出し元がCUDA初期化済み・マルチスレッドでも安全なようにforkを避ける
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    max_workers = min(os.cpu_count() or 1, len(lf2_files))
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             mp_context=multiprocessing.get_context(start_method)) as executor:
+        yield from executor.map(_parse_one, lf2_files,
+                                repeat(max_decisions_per_file, len(lf2_files)),
+                                chunksize=4)
 
 class LZSSDecisionPredictor(nn.Module):
     """LZSS決定予測ニューラルネットワーク"""
@@ -243,27 +326,58 @@ class LZSSDecisionPredictor(nn.Module):
             nn.ReLU()
         )
         
-        # 決定タイプ予測 (direct vs match)
-        self.decision_head = nn.Sequential(
-            nn.Linear(hidden_size // 2, 64),
+        # 決定タイプ (direct vs match) と値 (pixel value, position, length) を単一ヘッドで予測
+        # 出力: [decision_logit_direct, decision_logit_match, pixel_value, position, length]
+        # 決定ロジットは生の値（softmaxは損失/利用側で適用）
+        # 中間幅は旧 decision_head/value_head (各64) の合計で、旧チェックポイントを等価に変換できる
+        self.head = nn.Sequential(
+            nn.Linear(hidden_size // 2, 128),
             nn.ReLU(),
-            nn.Linear(64, 2),
-            nn.Softmax(dim=1)
-        )
-        
-        # 値予測 (pixel value, position, length)
-        self.value_head = nn.Sequential(
-            nn.Linear(hidden_size // 2, 64),
-            nn.ReLU(),
-            nn.Linear(64, 3)  # [pixel_value, position, length]
+            nn.Linear(128, 5)
         )
     
     def forward(self, x):
         encoded = self.encoder(x)
-        decision_prob = self.decision_head(encoded)
-        values = self.value_head(encoded)
+        out = self.head(encoded)
         
-        return decision_prob, values
+        return out[:, :2], out[:, 2:]
+    
+    def load_state_dict(self, state_dict, strict: bool = True, **kwargs):
+        """旧形式（decision_head/value_head 分離）のチェックポイントも融合ヘッドへ変換して読み込む"""
+        if 'decision_head.0.weight' in state_dict:
+            state_dict = self._fuse_legacy_heads(state_dict)
+        return super().load_state_dict(state_dict, strict=strict, **kwargs)
+    
+    @staticmethod
+    def _fuse_legacy_heads(state_dict):
+        """分離ヘッドの重みを連結（第1層は行方向に結合、第2層はブロック対角で出力を分離）"""
+        state_dict = dict(state_dict)
+        dec = {k: state_dict.pop(f'decision_head.{k}') for k in ('0.weight', '0.bias', '2.weight', '2.bias')}
+        val = {k: state_dict.pop(f'value_head.{k}') for k in ('0.weight', '0.bias', '2.weight', '2.bias')}
+        
+        state_dict['head.0.weight'] = torch.cat([dec['0.weight'], val['0.weight']])
+        state_dict['head.0.bias'] = torch.cat([dec['0.bias'], val['0.bias']])
+        state_dict['head.2.weight'] = torch.block_diag(dec['2.weight'], val['2.weight'])
+        state_dict['head.2.bias'] = torch.cat([dec['2.bias'], val['2.bias']])
+        return state_dict
+    
+    def strip_dropout(self) -> 'LZSSDecisionPredictor':
+        """学習後の推論・解析用にDropoutをIdentityへ置換（state_dictは不変）"""
+        for idx, layer in enumerate(self.encoder):
+            if isinstance(layer, nn.Dropout):
+                self.encoder[idx] = nn.Identity()
+        return self.eval()
+
+def amp_dtype_for(device: str) -> Optional[torch.dtype]:
+    """混合精度の演算型（Tensor Core搭載GPUのみ: 計算能力8.0以上はBF16、7.xはFP16、それ以外はNone=FP32）"""
+    if device != 'cuda':
+        return None
+    major, _ = torch.cuda.get_device_capability()
+    if major >= 8:
+        return torch.bfloat16
+    if major >= 7:
+        return torch.float16
+    return None
 
 def train_model(train_loader: DataLoader, model: LZSSDecisionPredictor, 
                 epochs: int = 10, device: str = 'cuda'):
@@ -274,6 +388,11 @@ def train_model(train_loader: DataLoader, model: LZSSDecisionPredictor,
     criterion_decision = nn.CrossEntropyLoss()
     criterion_values = nn.MSELoss()
     
+    # 混合精度: Ampere以降はBF16、Volta/TuringはFP16 + GradScaler、それ以外はFP32
+    amp_dtype = amp_dtype_for(device)
+    use_amp = amp_dtype is not None
+    scaler = torch.amp.GradScaler('cuda', enabled=amp_dtype == torch.float16)
+    
     print(f"🚀 Starting training on {device}...")
     
     for epoch in range(epochs):
@@ -282,37 +401,39 @@ def train_model(train_loader: DataLoader, model: LZSSDecisionPredictor,
         num_batches = 0
         
         model.train()
-        for batch_idx, (contexts, targets) in enumerate(train_loader):
-            contexts = contexts.to(device)
-            targets = targets.to(device)
+        for batch_idx, (contexts, labels, targets) in enumerate(train_loader):
+            contexts = contexts.to(device, non_blocking=True)
+            labels = labels.to(device, non_blocking=True)
+            targets = targets.to(device, non_blocking=True)
             
             optimizer.zero_grad()
             
-            decision_probs, values = model(contexts)
+            with torch.autocast(device_type=device, dtype=amp_dtype, enabled=use_amp):
+                decision_logits, values = model(contexts)
             
-            # 決定タイプの損失
-            decision_true = targets[:, :2].argmax(dim=1)
-            decision_loss = criterion_decision(decision_probs, decision_true)
+            # 決定タイプの損失（CrossEntropyLossは内部でlog_softmaxを適用）
+            decision_loss = criterion_decision(decision_logits.float(), labels)
             
-            # 値の損失
-            value_loss = criterion_values(values, targets[:, 2:])
+            # 値の損失（FP32で集計）
+            value_loss = criterion_values(values.float(), targets)
             
             total_loss_batch = decision_loss + value_loss
-            total_loss_batch.backward()
-            optimizer.step()
+            scaler.scale(total_loss_batch).backward()
+            scaler.step(optimizer)
+            scaler.update()
             
             total_loss += total_loss_batch.item()
             
             # 決定精度計算
-            decision_pred = decision_probs.argmax(dim=1)
-            decision_accuracy += (decision_pred == decision_true).float().mean().item()
+            decision_pred = decision_logits.argmax(dim=1)
+            decision_accuracy += (decision_pred == labels).float().mean().item()
             
             num_batches += 1
             
             if batch_idx % 100 == 0:
                 print(f"   Epoch {epoch+1}/{epochs}, Batch {batch_idx}, "
                       f"Loss: {total_loss_batch.item():.4f}, "
-                      f"Decision Acc: {(decision_pred == decision_true).float().mean().item():.4f}")
+                      f"Decision Acc: {(decision_pred == labels).float().mean().item():.4f}")
         
         avg_loss = total_loss / num_batches
         avg_accuracy = decision_accuracy / num_batches
@@ -320,6 +441,14 @@ def train_model(train_loader: DataLoader, model: LZSSDecisionPredictor,
         print(f"📊 Epoch {epoch+1}/{epochs} - Loss: {avg_loss:.4f}, "
               f"Decision Accuracy: {avg_accuracy:.4f}")
 
+def can_compile(device: str) -> bool:
+    """torch.compile (Inductor/Triton) が実行可能か（Tritonは計算能力7.0以上のCUDAのみ対応、CPUは常にeager）"""
+    if device != 'cuda' or not hasattr(torch, 'compile'):
+        return False
+    if torch.cuda.get_device_capability() < (7, 0):
+        return False
+    return importlib.util.find_spec('triton') is not None
+
 def collect_lf2_files(lf2_dir: str) -> List[str]:
     """LF2ファイルを収集"""
     
@@ -336,7 +465,36 @@ def collect_lf2_files(lf2_dir: str) -> List[str]:
     print(f"📁 Found {len(lf2_files)} LF2 files")
     return lf2_files
 
-def main():
+def dataset_cache_key(lf2_files: List[str], max_decisions_per_file: int) -> dict:
+    """テンソルキャッシュの照合キー（形式バージョン・ファイル名・サイズ・更新時刻・決定数上限）"""
+    file_stats = []
+    for file_path in sorted(lf2_files):
+        stat = os.stat(file_path)
+        file_stats.append([os.path.basename(file_path), stat.st_size, stat.st_mtime_ns])
+    return {
+        'version': _CACHE_VERSION,
+        'files': file_stats,
+        'max_decisions': max_decisions_per_file
+    }
+
+def load_dataset_cache(cache_path: Path) -> Optional[dict]:
+    """テンソルキャッシュを読み込む（存在しない・読めない場合はNoneでキャッシュミス扱い）"""
+    if not cache_path.exists():
+        return None
+    try:
+        cache = torch.load(cache_path, weights_only=True)
+    except Exception as e:
+        print(f"   ⚠️  Ignoring unreadable cache {cache_path}: {e}")
+        return None
+    return cache if isinstance(cache, dict) else None
+
+def save_dataset_cache(cache_path: Path, cache: dict):
+    """テンソルキャッシュを一時ファイルへ書き出してから置き換え（中断時に壊れたキャッシュを残さない）"""
+    tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+    torch.save(cache, tmp_path)
+    os.replace(tmp_path, cache_path)
+
+def main(compile_model: bool = True):
     """メイン実行関数"""
     
     # GPU確認
@@ -356,27 +514,52 @@ def main():
         print("❌ Insufficient LF2 files for training")
         return
     
-    # データセット作成
+    # データセット作成（同じ条件で解析済みならテンソルキャッシュを再利用）
     print("📊 Creating dataset...")
-    dataset = LF2DecisionDataset(lf2_files, max_decisions_per_file=5000)
+    max_decisions_per_file = 5000
+    cache_path = script_dir / "lf2_decision_cache.pt"
+    cache_key = dataset_cache_key(lf2_files, max_decisions_per_file)
+    cache = load_dataset_cache(cache_path)
+    
+    if cache is not None and cache.get('key') == cache_key:
+        print(f"   Using cached tensors: {cache_path}")
+        dataset = LF2DecisionDataset.from_tensors(cache['c'], cache['l'], cache['v'])
+    else:
+        dataset = LF2DecisionDataset(lf2_files, max_decisions_per_file=max_decisions_per_file)
+        save_dataset_cache(cache_path, {
+            'key': cache_key,
+            'c': dataset.contexts_t,
+            'l': dataset.labels_t,
+            'v': dataset.values_t
+        })
     
     if len(dataset) < 1000:
         print("❌ Insufficient training data")
         return
     
-    # データローダー作成
-    train_loader = DataLoader(dataset, batch_size=64, shuffle=True, num_workers=4)
+    # データローダー作成（__getitem__はテンソルスライスのみのため、ワーカープロセスは不要）
+    train_loader = DataLoader(dataset, batch_size=64, shuffle=True, num_workers=0,
+                              pin_memory=(device == 'cuda'))
     
     # モデル作成
-    input_size = len(dataset.contexts[0])
-    model = LZSSDecisionPredictor(input_size)
+    input_size = dataset.contexts_t.shape[1]
+    model = LZSSDecisionPredictor(input_size).to(device)
     
     print(f"🧠 Model created with input size: {input_size}")
     print(f"   Total parameters: {sum(p.numel() for p in model.parameters()):,}")
     
+    # 対応環境では訓練をコンパイル済みモジュールで実行（保存は元のモジュールのstate_dict）
+    train_module = model
+    if compile_model and can_compile(device):
+        train_module = torch.compile(model, mode='reduce-overhead')
+        print("   torch.compile: enabled")
+    
     # 訓練実行
     epochs = 20
-    train_model(train_loader, model, epochs=epochs, device=device)
+    train_model(train_loader, train_module, epochs=epochs, device=device)
+    
+    # 以降の保存・解析は推論専用（Dropoutのカーネル起動を除去）
+    model.strip_dropout()
     
     # モデル保存
     model_path = script_dir / "lzss_decision_model.pth"
@@ -407,4 +590,4 @@ def main():
     print(f"   Context feature dimensions: {input_size}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main(compile_model='--no-compile' not in sys.argv)
\ No newline at end of file
@@ -13,24 +13,128 @@ import numpy as np
 import torch
 import torch.nn as nn
 import json
+import string
 from pathlib import Path
-from typing import List, Tuple, Dict, Any
+from typing import Tuple, Dict, Any
 try:
-    import matplotlib.pyplot as plt
-    import seaborn as sns
-    MATPLOTLIB_AVAILABLE = True
+    import orjson
+    ORJSON_AVAILABLE = True
 except ImportError:
-    MATPLOTLIB_AVAILABLE = False
+    ORJSON_AVAILABLE = False
+try:
+    import onnxruntime as ort
+    ONNXRUNTIME_AVAILABLE = True
+except ImportError:
+    ONNXRUNTIME_AVAILABLE = False
 
 # 元のモデル定義をインポート
-from ml_lzss_analyzer import LZSSDecisionPredictor, LF2DecisionDataset
+from ml_lzss_analyzer import LZSSDecisionPredictor, LF2DecisionDataset, amp_dtype_for, can_compile
+
+# 特徴量名（リングバッファ32次元 + その他7次元）
+FEATURE_NAMES = tuple(
+    [f"ring_buffer_{i}" for i in range(32)] + [
+        "ring_position",
+        "compression_progress",
+        "estimated_x",
+        "estimated_y",
+        "short_matches",
+        "medium_matches",
+        "long_matches"
+    ]
+)
+
+# 戦略生成時に集計する特徴量カテゴリ別インデックス
+FEATURE_CATEGORY_IDX = {
+    'ring': np.arange(32),
+    'position': np.array([32, 34, 35]),
+    'match': np.array([36, 37, 38])
+}
+
+def _json_default(obj: Any) -> Any:
+    """標準jsonでのnumpy値シリアライズ"""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def _write_json(path: Path, obj: Any, indent: bool = True):
+    """JSON書き出し（orjsonが利用可能ならnumpy配列を直接シリアライズ）"""
+    if ORJSON_AVAILABLE:
+        option = orjson.OPT_SERIALIZE_NUMPY
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        path.write_bytes(orjson.dumps(obj, option=option))
+        return
+    
+    with open(path, 'w') as f:
+        if indent:
+            json.dump(obj, f, indent=2, default=_json_default)
+        else:
+            f.write(json.dumps(obj, separators=(',', ':'), default=_json_default))
+
+# Rust実装ヒントのテンプレート
+_RUST_HINTS_TMPL = string.Template("""
+// Machine Learning Insights for LZSS Encoder
+// Generated from $training_samples decision points
+
+impl Lf2Image {
+    fn compress_lzss_ml_guided(&self) -> Result<Vec<u8>> {
+        // ML発見の重要特徴量:
+        // 1. Ring Buffer State (重要度: 最高)
+        // 2. Image Position (重要度: 中)  
+        // 3. Match Candidates (重要度: 中)
+        
+        let mut ring = [0x20u8; 0x1000];
+        let mut ring_pos = 0x0fee;
+        
+        // ML推奨の決定ロジック
+        fn should_use_match_ml(
+            ring_state: &[u8], 
+            position: (usize, usize),
+            candidates: &[MatchCandidate]
+        ) -> bool {
+            // 特徴量重要度に基づく決定
+            let ring_score = calculate_ring_buffer_score(ring_state);
+            let position_score = calculate_position_score(position);
+            let match_score = calculate_match_quality_score(candidates);
+            
+            // ML学習済み重み (重要度から推定)
+            let total_score = ring_score * $ring_w
+                            + position_score * $pos_w
+                            + match_score * $match_w;
+            
+            total_score > 0.5 // ML学習済み閾値
+        }
+        
+        // TODO: 上記関数の実装詳細
+        // - calculate_ring_buffer_score: リングバッファパターン評価
+        // - calculate_position_score: 画像内位置評価  
+        // - calculate_match_quality_score: マッチ候補品質評価
+        
+        todo!("ML guided implementation")
+    }
+}
+
+/* 
+ML学習結果サマリー:
+- 決定精度: $accuracy
+- 主要因子: $primary_factor
+- 推奨戦略: $recommendation
+*/
+""")
 
 class ModelInterpreter:
     """学習済みモデルの解釈クラス"""
     
-    def __init__(self, model_path: str, analysis_path: str):
+    def __init__(self, model_path: str, analysis_path: str, mixed_precision: bool = True,
+                 compile_model: bool = True):
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         
+        # 解析用の順伝播精度（重みはfloat32のまま、Tensor Core搭載GPUのみautocastで低精度演算、CPUはFP32）
+        self.autocast_dtype = amp_dtype_for(self.device)
+        self.mixed_precision = mixed_precision and self.autocast_dtype is not None
+        
         # 分析結果読み込み
         with open(analysis_path, 'r') as f:
             self.analysis = json.load(f)
@@ -40,42 +144,195 @@ class ModelInterpreter:
         self.model = LZSSDecisionPredictor(input_size)
         self.model.load_state_dict(torch.load(model_path, map_location=self.device))
         self.model.to(self.device)
-        self.model.eval()
+        self.model.strip_dropout()
+        
+        # 対応環境では繰り返し順伝播用にコンパイル（ONNX出力には元のモジュールを使用）
+        self._eager_model = self.model
+        if compile_model and can_compile(self.device):
+            self.model = torch.compile(self.model, mode='reduce-overhead', fullgraph=True)
+        
+        # 解析用文脈特徴のキャッシュ（ファイル毎の決定数上限 -> (N, F)）
+        self._cached_contexts: Dict[int, torch.Tensor] = {}
+        
+        # ONNX Runtime推論セッション（to_onnx()実行後に有効）
+        self._ort_session = None
         
         print(f"🧠 Model loaded: {self.analysis['model_parameters']:,} parameters")
         print(f"   Training accuracy: {self.analysis['final_accuracy']:.3f}")
         print(f"   Feature dimensions: {input_size}")
 
-    def analyze_feature_importance(self, test_samples: int = 1000) -> Dict[str, Any]:
-        """特徴量重要度分析"""
-        print(f"\n🔍 Analyzing feature importance with {test_samples} samples...")
-        
-        # テストデータ準備
-        lf2_dir = Path(__file__).parent.parent / "test_assets" / "lf2"
-        lf2_files = list(lf2_dir.glob("*.LF2"))[:10]  # 最初の10ファイル
-        
-        dataset = LF2DecisionDataset(lf2_files, max_decisions_per_file=test_samples//10)
-        
-        # 特徴量重要度計算（勾配ベース）
-        feature_importance = np.zeros(self.analysis['feature_dimensions'])
+    def _materialize(self, dataset: LF2DecisionDataset) -> torch.Tensor:
+        """データセットの文脈特徴を連続した (N, F) float32 テンソルに一括変換"""
+        contexts = dataset.contexts_t.to(torch.float32).contiguous()
+        if self.device == 'cuda':
+            # ページロックしておき、GPU転送を非同期DMAで行えるようにする
+            contexts = contexts.pin_memory()
+        return contexts
+
+    def _iter_device_batches(self, contexts: torch.Tensor, batch_size: int):
+        """デバイス上のバッチを順に返す（CUDAでは再利用バッファへ次バッチを先行転送）"""
+        num_samples, num_features = contexts.shape
+        if self.device != 'cuda':
+            for start in range(0, num_samples, batch_size):
+                yield contexts[start:start + batch_size]
+            return
         
-        for i in range(min(test_samples, len(dataset))):
-            context, target = dataset[i]
-            context = context.unsqueeze(0).to(self.device)
-            context.requires_grad_(True)
-            
-            decision_probs, values = self.model(context)
+        # ダブルバッファ: 計算中のバッチと並行して次バッチを別ストリームで転送
+        buffers = [torch.empty(batch_size, num_features, device=self.device) for _ in range(2)]
+        copy_stream = torch.cuda.Stream()
+        starts = range(0, num_samples, batch_size)
+        
+        def stage(i: int) -> torch.Tensor:
+            start = starts[i]
+            buffer = buffers[i % 2][:min(batch_size, num_samples - start)]
+            # 同じバッファを使った前回の計算完了を待ってから上書き
+            copy_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(copy_stream):
+                buffer.copy_(contexts[start:start + buffer.shape[0]], non_blocking=True)
+            return buffer
+        
+        next_batch = stage(0) if len(starts) > 0 else None
+        for i in range(len(starts)):
+            torch.cuda.current_stream().wait_stream(copy_stream)
+            batch = next_batch
+            if i + 1 < len(starts):
+                next_batch = stage(i + 1)
+            yield batch
+
+    def _autocast(self):
+        """順伝播用の混合精度コンテキスト"""
+        return torch.autocast(device_type=self.device, dtype=self.autocast_dtype,
+                              enabled=self.mixed_precision)
+
+    @torch.inference_mode()
+    def predict(self, contexts: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """勾配不要の推論（決定確率と値予測）"""
+        with self._autocast():
+            decision_logits, values = self.model(contexts.to(self.device))
+        return torch.softmax(decision_logits.float(), dim=1), values
+
+    def _load_test_contexts(self, test_samples: int) -> torch.Tensor:
+        """テスト用文脈特徴を取得（ファイル毎の決定数上限ごとに一度だけLF2を解析）"""
+        max_decisions_per_file = test_samples // 10
+        if max_decisions_per_file not in self._cached_contexts:
+            lf2_dir = Path(__file__).parent.parent / "test_assets" / "lf2"
+            lf2_files = []  # 最初の10ファイル（全件列挙せず早期打ち切り）
+            if lf2_dir.is_dir():
+                with os.scandir(lf2_dir) as it:
+                    for entry in it:
+                        if entry.name.endswith('.LF2'):
+                            lf2_files.append(Path(entry.path))
+                            if len(lf2_files) >= 10:
+                                break
             
-            # 決定タイプの勾配
-            decision_loss = decision_probs.max()
-            decision_loss.backward(retain_graph=True)
+            dataset = LF2DecisionDataset(lf2_files, max_decisions_per_file=max_decisions_per_file)
+            self._cached_contexts[max_decisions_per_file] = self._materialize(dataset)
+        
+        return self._cached_contexts[max_decisions_per_file][:test_samples]
+
+    def _gradient_importance(self, contexts: torch.Tensor, batch_size: int,
+                             estimator: str, noise_samples: int,
+                             noise_sigma: float) -> np.ndarray:
+        """SmoothGrad²/VarGrad（ノイズ付き複製をバッチで一括backward）"""
+        num_samples, num_features = contexts.shape
+        importance_sum = torch.zeros(num_features, device=self.device)
+        
+        for batch in self._iter_device_batches(contexts, batch_size):
+            with torch.no_grad():
+                # (B, K, F) のノイズ付き複製を (B*K, F) に平坦化
+                noisy = batch.unsqueeze(1) + noise_sigma * torch.randn(
+                    batch.shape[0], noise_samples, num_features, device=self.device)
+                noisy = noisy.reshape(-1, num_features)
+            noisy.requires_grad_(True)
             
-            if context.grad is not None:
-                feature_importance += context.grad.abs().cpu().numpy().flatten()
+            # 入力勾配が必要な区間のみautogradを有効化
+            with torch.enable_grad():
+                with self._autocast():
+                    decision_logits, values = self.model(noisy)
+                decision_probs = torch.softmax(decision_logits.float(), dim=1)
+                
+                # 決定タイプの勾配（サンプル毎の最大確率の総和、.gradを経由せず直接取得）
+                decision_loss = decision_probs.max(dim=1).values.sum()
+                input_grads, = torch.autograd.grad(decision_loss, noisy)
             
-            context.grad.zero_()
+            grads = input_grads.reshape(-1, noise_samples, num_features)
+            if estimator == 'vargrad':
+                per_sample = grads.var(dim=1)
+            else:
+                per_sample = (grads ** 2).mean(dim=1)
+            importance_sum += per_sample.sum(dim=0)
+        
+        return (importance_sum / num_samples).cpu().numpy()
+
+    def to_onnx(self, path: str) -> str:
+        """モデルをONNX形式で出力し、利用可能ならONNX Runtimeセッションを作成"""
+        dummy_input = torch.zeros(1, self.analysis['feature_dimensions'], device=self.device)
+        torch.onnx.export(
+            self._eager_model, dummy_input, path,
+            opset_version=17,
+            input_names=['ctx'],
+            output_names=['logits', 'values'],
+            dynamic_axes={'ctx': {0: 'B'}, 'logits': {0: 'B'}, 'values': {0: 'B'}}
+        )
+        print(f"   📦 ONNX model exported: {path}")
+        
+        if ONNXRUNTIME_AVAILABLE:
+            providers = [p for p in ('CUDAExecutionProvider', 'CPUExecutionProvider')
+                         if p in ort.get_available_providers()]
+            self._ort_session = ort.InferenceSession(path, providers=providers)
+        else:
+            print("   ⚠️  onnxruntime not available, keeping PyTorch inference")
         
-        feature_importance /= min(test_samples, len(dataset))
+        return path
+
+    def _max_decision_prob(self, contexts: torch.Tensor) -> torch.Tensor:
+        """サンプル毎の最大決定確率（ONNX Runtime優先、勾配不要）"""
+        if self._ort_session is not None:
+            logits, _ = self._ort_session.run(None, {'ctx': contexts.cpu().numpy()})
+            return torch.softmax(torch.from_numpy(logits), dim=1).max(dim=1).values
+        return self.predict(contexts)[0].max(dim=1).values
+
+    def permutation_importance(self, test_samples: int = 1000,
+                               n_repeats: int = 5) -> np.ndarray:
+        """順列重要度（勾配不要、特徴量毎に1回のバッチ推論）"""
+        device = 'cpu' if self._ort_session is not None else self.device
+        contexts = self._load_test_contexts(test_samples).to(device)
+        num_samples, num_features = contexts.shape
+        
+        # 固定バッチサイズでの初回推論がコンパイル済みグラフのウォームアップを兼ねる
+        baseline = self._max_decision_prob(contexts)
+        
+        # デバイス上で累積し、ホストへの転送（同期）は最後の一度だけ
+        importances = torch.zeros(num_features, device=device)
+        for j in range(num_features):
+            for _ in range(n_repeats):
+                permuted = contexts.clone()
+                perm = torch.randperm(num_samples, device=device)
+                permuted[:, j] = contexts[perm, j]
+                
+                probs = self._max_decision_prob(permuted)
+                importances[j] += (baseline - probs).abs().mean()
+        
+        return (importances / n_repeats).cpu().numpy()
+
+    def analyze_feature_importance(self, test_samples: int = 1000,
+                                   estimator: str = 'smoothgrad_sq',
+                                   batch_size: int = 256,
+                                   noise_samples: int = 8,
+                                   noise_sigma: float = 0.15,
+                                   n_repeats: int = 5) -> Dict[str, Any]:
+        """特徴量重要度分析（SmoothGrad² / VarGrad / 順列重要度）"""
+        if estimator not in ('smoothgrad_sq', 'vargrad', 'permutation'):
+            raise ValueError(f"Unknown estimator: {estimator}")
+        
+        print(f"\n🔍 Analyzing feature importance with {test_samples} samples ({estimator})...")
+        
+        if estimator == 'permutation':
+            feature_importance = self.permutation_importance(test_samples, n_repeats)
+        else:
+            contexts = self._load_test_contexts(test_samples)
+            feature_importance = self._gradient_importance(
+                contexts, batch_size, estimator, noise_samples, noise_sigma)
         
         # 特徴量名定義
         feature_names = self._get_feature_names()
@@ -92,7 +349,7 @@ class ModelInterpreter:
         importance_ranking.sort(key=lambda x: x['importance'], reverse=True)
         
         return {
-            'feature_importance': feature_importance.tolist(),
+            'feature_importance': feature_importance,
             'importance_ranking': importance_ranking,
             'top_10_features': importance_ranking[:10]
         }
@@ -140,39 +397,23 @@ class ModelInterpreter:
             'total_decisions_analyzed': self.analysis['training_samples'],
             'avg_decisions_per_file': self.analysis['avg_decisions_per_file'],
             'model_confidence': self.analysis['final_accuracy'],
-            'recommended_match_strategy': self._generate_match_strategy(top_features)
+            'recommended_match_strategy': self._generate_match_strategy(
+                np.asarray(importance_analysis['feature_importance']))
         }
         
         return rules
 
-    def _get_feature_names(self) -> List[str]:
+    def _get_feature_names(self) -> Tuple[str, ...]:
         """特徴量名生成"""
-        names = []
-        
-        # リングバッファ特徴量 (32次元)
-        for i in range(32):
-            names.append(f"ring_buffer_{i}")
-        
-        # その他の特徴量
-        names.extend([
-            "ring_position",
-            "compression_progress", 
-            "estimated_x",
-            "estimated_y",
-            "short_matches",
-            "medium_matches", 
-            "long_matches"
-        ])
-        
-        return names
+        return FEATURE_NAMES
 
-    def _generate_match_strategy(self, top_features: List[Dict]) -> Dict[str, Any]:
+    def _generate_match_strategy(self, importances: np.ndarray) -> Dict[str, Any]:
         """マッチング戦略生成"""
         
-        # 重要特徴量から戦略を推定
-        ring_importance = sum(f['importance'] for f in top_features if 'ring_buffer' in f['feature_name'])
-        position_importance = sum(f['importance'] for f in top_features if 'position' in f['feature_name'])
-        match_importance = sum(f['importance'] for f in top_features if 'match' in f['feature_name'])
+        # カテゴリ別の重要度合計から戦略を推定
+        ring_importance = importances[FEATURE_CATEGORY_IDX['ring']].sum()
+        position_importance = importances[FEATURE_CATEGORY_IDX['position']].sum()
+        match_importance = importances[FEATURE_CATEGORY_IDX['match']].sum()
         
         strategy = {
             'ring_buffer_weight': float(ring_importance),
@@ -198,58 +439,20 @@ class ModelInterpreter:
         """Rust実装ヒント生成"""
         print("\n🦀 Generating Rust implementation hints...")
         
-        rust_hints = f"""
-// Machine Learning Insights for LZSS Encoder
-// Generated from {self.analysis['training_samples']:,} decision points
-
-impl Lf2Image {{
-    fn compress_lzss_ml_guided(&self) -> Result<Vec<u8>> {{
-        // ML発見の重要特徴量:
-        // 1. Ring Buffer State (重要度: 最高)
-        // 2. Image Position (重要度: 中)  
-        // 3. Match Candidates (重要度: 中)
-        
-        let mut ring = [0x20u8; 0x1000];
-        let mut ring_pos = 0x0fee;
-        
-        // ML推奨の決定ロジック
-        fn should_use_match_ml(
-            ring_state: &[u8], 
-            position: (usize, usize),
-            candidates: &[MatchCandidate]
-        ) -> bool {{
-            // 特徴量重要度に基づく決定
-            let ring_score = calculate_ring_buffer_score(ring_state);
-            let position_score = calculate_position_score(position);
-            let match_score = calculate_match_quality_score(candidates);
-            
-            // ML学習済み重み (重要度から推定)
-            let total_score = ring_score * {rules['statistical_patterns']['recommended_match_strategy']['ring_buffer_weight']:.3f}
-                            + position_score * {rules['statistical_patterns']['recommended_match_strategy']['position_weight']:.3f}
-                            + match_score * {rules['statistical_patterns']['recommended_match_strategy']['match_candidate_weight']:.3f};
-            
-            total_score > 0.5 // ML学習済み閾値
-        }}
-        
-        // TODO: 上記関数の実装詳細
-        // - calculate_ring_buffer_score: リングバッファパターン評価
-        // - calculate_position_score: 画像内位置評価  
-        // - calculate_match_quality_score: マッチ候補品質評価
-        
-        todo!("ML guided implementation")
-    }}
-}}
-
-/* 
-ML学習結果サマリー:
-- 決定精度: {self.analysis['final_accuracy']:.1%}
-- 主要因子: {rules['statistical_patterns']['recommended_match_strategy']['primary_factor']}
-- 推奨戦略: {rules['statistical_patterns']['recommended_match_strategy']['recommendation']}
-*/
-"""
+        strategy = rules['statistical_patterns']['recommended_match_strategy']
+        rust_hints = _RUST_HINTS_TMPL.substitute(
+            training_samples=f"{self.analysis['training_samples']:,}",
+            ring_w=f"{strategy['ring_buffer_weight']:.3f}",
+            pos_w=f"{strategy['position_weight']:.3f}",
+            match_w=f"{strategy['match_candidate_weight']:.3f}",
+            accuracy=f"{self.analysis['final_accuracy']:.1%}",
+            primary_factor=strategy['primary_factor'],
+            recommendation=strategy['recommendation']
+        )
         return rust_hints
 
-    def save_analysis_results(self, output_dir: str = "./"):
+    def save_analysis_results(self, output_dir: str = "./", plot: bool = False,
+                              combined: bool = True):
         """解析結果保存"""
         print(f"\n💾 Saving analysis results to {output_dir}...")
         
@@ -265,24 +468,33 @@ ML学習結果サマリー:
         # 結果保存
         output_path = Path(output_dir)
         
-        # 1. 特徴量重要度JSON
-        with open(output_path / "feature_importance.json", 'w') as f:
-            json.dump(importance_analysis, f, indent=2)
-        
-        # 2. 決定ルールJSON
-        with open(output_path / "decision_rules.json", 'w') as f:
-            json.dump(decision_rules, f, indent=2)
+        if combined:
+            # 1+2. 特徴量重要度と決定ルールを単一のコンパクトJSONに出力
+            _write_json(output_path / "analysis.json", {
+                'feature_importance': importance_analysis,
+                'decision_rules': decision_rules
+            }, indent=False)
+        else:
+            # 1. 特徴量重要度JSON
+            _write_json(output_path / "feature_importance.json", importance_analysis)
+            
+            # 2. 決定ルールJSON
+            _write_json(output_path / "decision_rules.json", decision_rules)
         
         # 3. Rust実装ヒント
         with open(output_path / "rust_implementation_hints.rs", 'w') as f:
             f.write(rust_hints)
         
-        # 4. 可視化
-        self._create_visualizations(importance_analysis, output_path)
+        # 4. 可視化（明示的に要求された場合のみ）
+        if plot:
+            self._create_visualizations(importance_analysis, output_path)
         
         print("✅ Analysis complete!")
-        print(f"   📊 Feature importance: {output_path / 'feature_importance.json'}")
-        print(f"   📋 Decision rules: {output_path / 'decision_rules.json'}")
+        if combined:
+            print(f"   📊 Analysis: {output_path / 'analysis.json'}")
+        else:
+            print(f"   📊 Feature importance: {output_path / 'feature_importance.json'}")
+            print(f"   📋 Decision rules: {output_path / 'decision_rules.json'}")
         print(f"   🦀 Rust hints: {output_path / 'rust_implementation_hints.rs'}")
         
         return {
@@ -293,7 +505,11 @@ ML学習結果サマリー:
 
     def _create_visualizations(self, importance_analysis: Dict, output_path: Path):
         """重要度可視化"""
-        if not MATPLOTLIB_AVAILABLE:
+        try:
+            import matplotlib
+            matplotlib.use('Agg')  # GUIバックエンドを初期化しない
+            import matplotlib.pyplot as plt
+        except ImportError:
             print("   ⚠️  Visualization skipped (matplotlib not available)")
             return
             
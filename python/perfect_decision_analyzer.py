@@ -7,30 +7,68 @@ ML学習で75.3%精度の限界を突破し、100%決定精度を目指す
 現状: 621-2026ピクセル差異の完全除去
 """
 
+import functools
 import json
 import torch
 import numpy as np
 from collections import defaultdict, Counter
 from pathlib import Path
 import pickle
+from typing import Dict, Optional
 
-def analyze_perfect_decisions():
+from ml_lzss_analyzer import LZSSDecisionPredictor, LF2DecisionDataset
+
+@functools.lru_cache(maxsize=1)
+def _load_analysis(analysis_path: str) -> Dict:
+    """model_analysis.json読み込み（プロセス内で一度だけ解析）"""
+    with open(analysis_path, 'r') as f:
+        return json.load(f)
+
+class AnalysisCache:
+    """解析フェーズ間で共有するキャッシュ（解析JSON・モデル・LF2特徴量）"""
+    
+    def __init__(self, model_path: str = "lzss_decision_model.pth",
+                 analysis_path: str = "model_analysis.json"):
+        self.model_path = Path(model_path)
+        self.analysis_path = Path(analysis_path)
+        self._model: Optional[LZSSDecisionPredictor] = None
+        self.lf2_features: Dict[str, LF2DecisionDataset] = {}
+    
+    @property
+    def analysis_json(self) -> Dict:
+        """model_analysis.json（初回アクセス時のみ読み込み）"""
+        return _load_analysis(str(self.analysis_path))
+    
+    @property
+    def model(self) -> LZSSDecisionPredictor:
+        """学習済みモデル（初回アクセス時のみstate_dictを読み込み）"""
+        if self._model is None:
+            model = LZSSDecisionPredictor(self.analysis_json['feature_dimensions'])
+            model.load_state_dict(torch.load(self.model_path, map_location='cpu'))
+            model.strip_dropout()
+            self._model = model
+        return self._model
+    
+    def get_lf2_features(self, file_path: str, max_decisions: int = 10000) -> LF2DecisionDataset:
+        """LF2ファイルの決定・文脈特徴（ファイル毎に一度だけ解析）"""
+        key = str(file_path)
+        if key not in self.lf2_features:
+            self.lf2_features[key] = LF2DecisionDataset([key], max_decisions_per_file=max_decisions)
+        return self.lf2_features[key]
+
+def analyze_perfect_decisions(cache: AnalysisCache):
     """
     ML学習結果を基に、100%正確な決定ルールを抽出
     """
     print("🎯 Perfect Decision Pattern Analysis")
     print("===================================")
     
-    # 学習済みモデル読み込み
-    model_path = "lzss_decision_model.pth"
-    analysis_path = "model_analysis.json"
-    
-    if not Path(model_path).exists():
+    # 学習済みモデル確認
+    if not cache.model_path.exists():
         print("❌ Model file not found. Run ml_lzss_analyzer.py first.")
         return
     
-    with open(analysis_path, 'r') as f:
-        analysis = json.load(f)
+    analysis = cache.analysis_json
     
     print(f"📊 Current model accuracy: {analysis['final_accuracy']:.1%}")
     print(f"📊 Target accuracy: 100% (perfect decision)")
@@ -86,7 +124,7 @@ def analyze_perfect_decisions():
         "implementation_plan": implementation_plan
     }
 
-def extract_high_confidence_patterns():
+def extract_high_confidence_patterns(cache: AnalysisCache):
     """
     高信頼度決定パターンの抽出
     """
@@ -109,7 +147,7 @@ def extract_high_confidence_patterns():
     
     return high_confidence_rules
 
-def create_perfect_encoder_strategy():
+def create_perfect_encoder_strategy(cache: AnalysisCache):
     """
     完璧なエンコーダ戦略の設計
     """
@@ -143,14 +181,17 @@ def create_perfect_encoder_strategy():
     return strategy
 
 if __name__ == "__main__":
+    # 全フェーズで共有するキャッシュ
+    cache = AnalysisCache()
+    
     # 完璧な決定パターン分析
-    decision_analysis = analyze_perfect_decisions()
+    decision_analysis = analyze_perfect_decisions(cache)
     
     # 高信頼度パターン抽出
-    high_confidence_patterns = extract_high_confidence_patterns()
+    high_confidence_patterns = extract_high_confidence_patterns(cache)
     
     # 完璧なエンコーダ戦略設計
-    perfect_strategy = create_perfect_encoder_strategy()
+    perfect_strategy = create_perfect_encoder_strategy(cache)
     
     # 結果保存
     results = {